@@ -4,13 +4,11 @@ Authors: Florian Kolbl / Roland Giraud / Louis Regnacq
 (c) ETIS - University Cergy-Pontoise - CNRS
 """
 import faulthandler
-from collections.abc import Iterable
-import matplotlib.pyplot as plt
+from functools import lru_cache
 import numpy as np
-from pylab import argmin,argmax
 from scipy import signal
 from numba import jit
-from .file_handler import json_dump, json_load, is_iterable
+from .file_handler import json_dump, json_load
 from .log_interface import rise_error, rise_warning, pass_info
 
 # enable faulthandler to ease 'segmentation faults' debug
@@ -22,13 +20,14 @@ faulthandler.enable()
 def distance_point2line(x_p,y_p,a,b):
     '''
     Computes the distance between a point (x_p,y_p) and a line defined as y=a*x+b
+    Points can be given as arrays to compute all distances at once.
 
     Parameters
     ----------
-    x_p : float
-        point x coordinate,
-    y_p : float
-        point y coordinate,
+    x_p : float or array, list, np.array
+        point(s) x coordinate,
+    y_p : float or array, list, np.array
+        point(s) y coordinate,
     a   : float
         line direction coeefficient
     b   : float
@@ -36,10 +35,12 @@ def distance_point2line(x_p,y_p,a,b):
 
     Returns
     --------
-    d : float
-        distance between the point and the orthogonal projection of (x_p,y_p) on it
+    d : float or np.array
+        distance between the point(s) and the orthogonal projection of (x_p,y_p) on it
     '''
-    d = np.abs(a*x_p - y_p + b)/(np.sqrt(a**2 + 1))
+    x_p = np.asarray(x_p)
+    y_p = np.asarray(y_p)
+    d = np.abs(a*x_p - y_p + b)*(1/np.sqrt(a*a + 1))
     return d
 
 #####################################
@@ -68,19 +69,14 @@ def load_simulation_from_json(filename):
         name of the file where axons simulations are saved
     """
     results = json_load(filename)
-    # convert iterables to numpy arrays
-    int_iterables = ['node_index','Markov_Nav_modeled_NoR','V_mem_raster_position','V_mem_filtered_raster_position','V_mem_raster_time_index','V_mem_filtered_raster_time_index']
+    # convert lists to numpy arrays, integer ones being identified by their keys
+    int_iterables = frozenset(['node_index','Markov_Nav_modeled_NoR','V_mem_raster_position','V_mem_filtered_raster_position','V_mem_raster_time_index','V_mem_filtered_raster_time_index'])
     for key, value in results.items():
-        if is_iterable(value):
+        if isinstance(value, list):
             if key in int_iterables:
                 results[key] = np.asarray(value,dtype=np.int16)
             else:
-                if isinstance(value,str):
-                    results[key] = value
-                else:
-                    results[key] = np.asarray(value,dtype=np.float32)
-        else:
-            results[key] = value
+                results[key] = np.asarray(value,dtype=np.float32)
     return results
 
 ##############################################
@@ -118,10 +114,8 @@ def remove_non_NoR_zones(my_dict, key):
     """
     if ('V_mem' in key):
         if my_dict['Axon_type'] == 'Myelinated':
-            new_entry = []
-            for i in my_dict['Nodes_of_Ranvier_indexes']:
-                new_entry.append(my_dict[key][i,:])
-            my_dict[key] = np.asarray(new_entry)
+            NoR_indexes = np.asarray(my_dict['Nodes_of_Ranvier_indexes'], dtype=np.intp)
+            my_dict[key] = my_dict[key][NoR_indexes]
         else:
             rise_warning('Warning, remove_non_NoR_zones only applicable to Myelinated axons')
     else:
@@ -130,6 +124,20 @@ def remove_non_NoR_zones(my_dict, key):
 ############################
 ## AXON SIGNAL PROCESSING ##
 ############################
+@lru_cache(maxsize=128)
+def notch_ba(f0, Q, fs):
+    """
+    Internal use only, IIR-notch filter coefficients, memoized as the design only depends on (f0, Q, fs)
+    """
+    return signal.iirnotch(f0, Q, fs)
+
+@lru_cache(maxsize=128)
+def notch_sos(f0, Q, fs):
+    """
+    Internal use only, IIR-notch filter as second order sections, memoized as the design only depends on (f0, Q, fs)
+    """
+    return signal.tf2sos(*notch_ba(f0, Q, fs))
+
 def filter_freq(my_dict,my_key,freq,Q=10):
     """
     Basic Filtering of quantities. This function design a notch filter (scipy IIR-notch).
@@ -147,28 +155,21 @@ def filter_freq(my_dict,my_key,freq,Q=10):
     Q       : float
         quality factor of the filter, by default set to 10
     """
-    if isinstance(freq, Iterable):
-        f0 = np.asarray(freq)
-    else:
-        f0 = freq
     if my_dict['dt'] == 0:
         rise_warning('Warning: filtering aborted, variable time step used for differential equation solving')
         return False
     else:
         fs = 1/my_dict['dt']
-        if isinstance(f0, Iterable):
-            new_sig = np.zeros(my_dict[my_key].shape)
-            for k in range(len(my_dict[my_key])):
-                new_sig[k,:] = my_dict[my_key][k]
-                for f in f0:
-                    b_notch, a_notch = signal.iirnotch(f, Q, fs)
-                    new_sig[k,:] = signal.lfilter(b_notch,a_notch,new_sig[k,:][k])
+        f0 = np.atleast_1d(freq)
+        sig = np.asarray(my_dict[my_key])
+        if len(f0) == 1:
+            ##  NOTCH at the stimulation frequency, all channels at once
+            b_notch, a_notch = notch_ba(float(f0[0]), float(Q), float(fs))
+            new_sig = signal.lfilter(b_notch, a_notch, sig, axis=-1)
         else:
-            ##  NOTCH at the stimulation frequency
-            b_notch, a_notch = signal.iirnotch(f0, Q, fs)
-            new_sig = np.zeros(my_dict[my_key].shape)
-            for k in range(len(my_dict[my_key])):
-                new_sig[k,:] = signal.lfilter(b_notch,a_notch,my_dict[my_key][k])
+            ## NOTCH at each frequency, cascaded as second order sections to filter all in a single pass
+            sos = np.vstack([notch_sos(float(f), float(Q), float(fs)) for f in f0])
+            new_sig = signal.sosfilt(sos, sig, axis=-1)
         my_dict[my_key+'_filtered'] = new_sig
 
 
@@ -219,34 +220,65 @@ def rasterize(my_dict,my_key,t_start=0,t_stop=0,t_min_spike=0.1,t_refractory=2,t
     else:
         list_to_parse = np.arange(len(my_dict['x_rec'])) #my_dict[my_key]
         x = my_dict['x_rec']
+    # thresholds are compared on the quantity in its own dtype, only non floating values are converted
+    V = np.asarray(my_dict[my_key])
+    if not np.issubdtype(V.dtype, np.floating):
+        V = V.astype(np.float32)
     # spike detection
-    my_dict[my_key+'_raster_position'], my_dict[my_key+'_raster_x_position'], my_dict[my_key+'_raster_time_index'], my_dict[my_key+'_raster_time'] = spike_detection(my_dict[my_key],my_dict['t'],x,list_to_parse, thr, my_dict['dt'], t_start, t_stop, t_refractory, t_min_spike)
+    list_to_parse = np.asarray(list_to_parse, dtype=np.int64)
+    my_dict[my_key+'_raster_position'], my_dict[my_key+'_raster_x_position'], my_dict[my_key+'_raster_time_index'], my_dict[my_key+'_raster_time'] = spike_detection(V,my_dict['t'],x,list_to_parse, thr, my_dict['dt'], t_start, t_stop, t_refractory, t_min_spike)
 
-@jit(nopython=True,fastmath=True)
 def spike_detection(Voltage, t, x, list_to_parse, thr, dt, t_start, t_stop, t_refractory, t_min_spike):
     """
-    Internal use only, spike detection just in time compiled to speed up the process
-    """
-    raster_position=[]
-    raster_x_position=[]
-    raster_time_index=[]
-    raster_time = []
-    # parsing to find spikes
-    for i in list_to_parse:
-        t_last_spike = t_start - t_refractory
-        for j in range(int(t_start*(1/dt)),t_stop):
-            if Voltage[i][j] <= thr and Voltage[i][j+1] >= thr \
-                and Voltage[i][min((j+int(t_min_spike*(1/dt))),t_stop)] >= thr \
-                and (j*dt - t_last_spike) > t_refractory: # 1st line: threshold crossing, 2nd: minimum time above threshold,3rd: refractory period
-                # there was a spike, get time and position
-                raster_position.append(i)
-                raster_x_position.append(x[i])
-                raster_time_index.append(j)
-                raster_time.append(t[j])
+    Internal use only, spike detection vectorized along time for each position, only the refractory period check is just in time compiled
+    """
+    list_to_parse = np.asarray(list_to_parse)
+    # loop invariants, computed once
+    inv_dt = 1/dt
+    j_start = int(t_start*inv_dt)
+    j_min_spike = int(t_min_spike*inv_dt)
+    t_stop = min(t_stop, Voltage.shape[1]-1)
+    j_last = t_stop - j_start
+    if t_stop <= j_start or len(list_to_parse) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0, dtype=np.int64), np.zeros(0)
+    if len(list_to_parse) == Voltage.shape[0] and np.array_equal(list_to_parse, np.arange(Voltage.shape[0])):
+        # all positions parsed in order, rows are read in place instead of being gathered in a copy
+        V = Voltage[:, j_start:t_stop+1]
+    else:
+        V = Voltage[list_to_parse, j_start:t_stop+1]
+    # scanned position by position, so that temporaries stay in cache
+    crossings = []
+    for k in range(len(V)):
+        # 1st: threshold crossing
+        candidates = np.flatnonzero((V[k,:-1] <= thr) & (V[k,1:] >= thr))
+        # 2nd: minimum time above threshold, only checked on the (few) threshold crossings
+        crossings.append(candidates[V[k, np.minimum(candidates + j_min_spike, j_last)] >= thr])
+    # candidates sorted by position then time
+    rows = np.repeat(np.arange(len(crossings)), [len(c) for c in crossings])
+    cols = np.concatenate(crossings) + j_start
+    # 3rd: refractory period, each position being processed independently
+    bounds = np.searchsorted(rows, np.arange(len(list_to_parse)+1))
+    is_spike = refractory_filter(cols, bounds, dt, t_start - t_refractory, t_refractory)
+    raster_position = list_to_parse[rows[is_spike]]
+    raster_time_index = cols[is_spike]
+    return raster_position, np.asarray(x)[raster_position], raster_time_index, np.asarray(t)[raster_time_index]
+
+@jit(nopython=True,fastmath=True,cache=True)
+def refractory_filter(candidates, bounds, dt, t_last_spike, t_refractory):
+    """
+    Internal use only, flags the threshold crossings that are not in the refractory period of a previous spike.
+    Candidates of the k-th position are candidates[bounds[k]:bounds[k+1]], just in time compiled
+    """
+    is_spike = np.zeros(len(candidates), dtype=np.bool_)
+    for k in range(len(bounds)-1):
+        t_last = t_last_spike
+        for c in range(bounds[k], bounds[k+1]):
+            t_candidate = candidates[c]*dt
+            if (t_candidate - t_last) > t_refractory:
+                is_spike[c] = True
                 # memorize the time in ms, to evaluate refractory period
-                t_last_spike = j*dt
-    # return results
-    return np.asarray(raster_position), np.asarray(raster_x_position), np.asarray(raster_time_index), np.asarray(raster_time)
+                t_last = t_candidate
+    return is_spike
 
 def find_spike_origin(my_dict,my_key=None,t_start=0,t_stop=0,x_min=None,x_max=None):
     """
@@ -288,26 +320,18 @@ def find_spike_origin(my_dict,my_key=None,t_start=0,t_stop=0,x_min=None,x_max=No
             return False
     else:
         good_key_prefix = my_key
-    # get data only in time windows
-    sup_indexes = np.where(my_dict[good_key_prefix+'_time']>t_start)
-    inf_indexes = np.where(my_dict[good_key_prefix+'_time']<t_stop)
-    good_indexes = np.intersect1d(sup_indexes, inf_indexes)
-    good_spike_times = my_dict[good_key_prefix+'_time'][good_indexes]
-    good_spike_positions = my_dict[good_key_prefix+'_x_position'][good_indexes]
-    # get data only in the z window if applicable
+    # get data only in time windows and in the x window if applicable
+    spike_times = my_dict[good_key_prefix+'_time']
+    spike_positions = my_dict[good_key_prefix+'_x_position']
+    mask = (spike_times>t_start) & (spike_times<t_stop)
     if x_min != None:
-        sup_xmin_indexes = np.where(good_spike_positions>x_min)
-    else:
-        sup_xmin_indexes = np.arange(len(good_spike_positions))
+        mask &= spike_positions>x_min
     if x_max != None:
-        inf_xmax_indexes = np.where(good_spike_positions<x_max)
-    else:
-        inf_xmax_indexes = np.arange(len(good_spike_positions))
-    good_x_indexes = np.intersect1d(sup_xmin_indexes,inf_xmax_indexes)
-    considered_spike_times = good_spike_times[good_x_indexes]
-    considered_spike_positions = good_spike_positions[good_x_indexes]
+        mask &= spike_positions<x_max
+    considered_spike_times = spike_times[mask]
+    considered_spike_positions = spike_positions[mask]
     # fin the minimum time corresponding to spike initiation
-    start_index = np.where(considered_spike_times == np.amin(considered_spike_times))
+    start_index = considered_spike_times.argmin()
     start_time = considered_spike_times[start_index]
     start_x_position = considered_spike_positions[start_index]
     return start_time, start_x_position
@@ -358,43 +382,31 @@ def find_spike_last_occurance(my_dict,my_key=None,t_start=0,t_stop=0,direction='
     if x_start == 0:
         t_start, x_start = find_spike_origin(my_dict,my_key=good_key_prefix,t_start=t_start,t_stop=t_stop)
     # get data only in time windows
-    sup_indexes = np.where(my_dict[good_key_prefix+'_time']>t_start)
-    inf_indexes = np.where(my_dict[good_key_prefix+'_time']<t_stop)
-    good_indexes = np.intersect1d(sup_indexes, inf_indexes)
-    considered_spike_times = my_dict[good_key_prefix+'_time'][good_indexes]
-    considered_spike_positions = my_dict[good_key_prefix+'_x_position'][good_indexes]
+    spike_times = my_dict[good_key_prefix+'_time']
+    spike_positions = my_dict[good_key_prefix+'_x_position']
+    mask = (spike_times>t_start) & (spike_times<t_stop)
+    upper_mask = mask & (spike_positions > x_start)
+    lower_mask = mask & (spike_positions < x_start)
     if direction=='up':
-        # find the spike in the upper region of the start
-        upper_spike_index = np.where(considered_spike_positions > x_start)
-        upper_spike_times = considered_spike_times[upper_spike_index]
-        upper_spike_positions = considered_spike_positions[upper_spike_index]
-        # find the last occurance
-        last_spike_index = np.where(upper_spike_times == np.amax(upper_spike_times))
+        # find the last occurance in the upper region of the start
+        upper_spike_times = spike_times[upper_mask]
+        last_spike_index = upper_spike_times.argmax()
         t_last = upper_spike_times[last_spike_index]
-        x_last = upper_spike_positions[last_spike_index]
+        x_last = spike_positions[upper_mask][last_spike_index]
     elif direction=='down':
-        # find the spike in the upper region of the start
-        lower_spike_index = np.where(considered_spike_positions < x_start)
-        lower_spike_times = considered_spike_times[lower_spike_index]
-        lower_spike_positions = considered_spike_positions[lower_spike_index]
-        # find the last occurance
-        last_spike_index = np.where(lower_spike_times == np.amax(lower_spike_times))
+        # find the last occurance in the lower region of the start
+        lower_spike_times = spike_times[lower_mask]
+        last_spike_index = lower_spike_times.argmax()
         t_last = lower_spike_times[last_spike_index]
-        x_last = lower_spike_positions[last_spike_index]
+        x_last = spike_positions[lower_mask][last_spike_index]
     else:
-        # find the spike in the upper region of the start
-        upper_spike_index = np.where(considered_spike_positions > x_start)
-        upper_spike_times = considered_spike_times[upper_spike_index]
-        upper_spike_positions = considered_spike_positions[upper_spike_index]
-        # find the spike in the upper region of the start
-        lower_spike_index = np.where(considered_spike_positions < x_start)
-        lower_spike_times = considered_spike_times[lower_spike_index]
-        lower_spike_positions = considered_spike_positions[lower_spike_index]
-        # find the last occurances
-        last_upper_spike_index = np.where(upper_spike_times == np.amax(upper_spike_times))
-        last_lower_spike_index = np.where(lower_spike_times == np.amax(lower_spike_times))
-        t_last = np.asarray([lower_spike_times[last_lower_spike_index][0],lower_spike_times[last_upper_spike_index]][0])
-        x_last = np.asarray([lower_spike_positions[last_lower_spike_index][0],lower_spike_positions[last_upper_spike_index]][0])
+        # find the last occurances in both regions, lower first
+        upper_spike_times = spike_times[upper_mask]
+        lower_spike_times = spike_times[lower_mask]
+        last_upper_spike_index = upper_spike_times.argmax()
+        last_lower_spike_index = lower_spike_times.argmax()
+        t_last = np.asarray([lower_spike_times[last_lower_spike_index],upper_spike_times[last_upper_spike_index]])
+        x_last = np.asarray([spike_positions[lower_mask][last_lower_spike_index],spike_positions[upper_mask][last_upper_spike_index]])
     return t_last, x_last
 
 def speed(my_dict,position_key=None,t_start=0,t_stop=0,x_start=0,x_stop=0):
@@ -429,7 +441,7 @@ def speed(my_dict,position_key=None,t_start=0,t_stop=0,x_start=0,x_stop=0):
     if t_stop == 0:
         t_stop = my_dict['tstop']
     if t_start==0:
-        if 'intra_stim_starts' in my_dict and my_dict['intra_stim_starts']!=[]:
+        if 'intra_stim_starts' in my_dict and len(my_dict['intra_stim_starts'])>0:
                 t_start=my_dict['intra_stim_starts'][0]
     if x_start==0:
         x_stop=my_dict['L']
@@ -445,19 +457,15 @@ def speed(my_dict,position_key=None,t_start=0,t_stop=0,x_start=0,x_stop=0):
             # there is no rasterized voltage, nothing to find
             return False
     else:
-        good_key_prefix = my_key
-    # get data only in time windows
-    sup_time_indexes = np.where(my_dict[good_key_prefix+'_time']>t_start)
-    inf_time_indexes = np.where(my_dict[good_key_prefix+'_time']<t_stop)
-    good_indexes_time = np.intersect1d(sup_time_indexes, inf_time_indexes)
-    sup_position_indexes = np.where(my_dict[good_key_prefix+'_x_position'][good_indexes_time]>=x_start)
-    inf_position_indexes = np.where(my_dict[good_key_prefix+'_x_position'][good_indexes_time]<=x_stop)
-    good_indexes_position = np.intersect1d(sup_position_indexes, inf_position_indexes)
-    good_indexes=np.intersect1d(good_indexes_position,good_indexes_time)
-    good_spike_times = my_dict[good_key_prefix+'_time'][good_indexes]
-    good_spike_positions = my_dict[good_key_prefix+'_x_position'][good_indexes]
-    max_time=np.argmax(good_spike_times)
-    min_time=np.argmin(good_spike_times)
+        good_key_prefix = position_key
+    # get data only in time and position windows
+    spike_times = my_dict[good_key_prefix+'_time']
+    spike_positions = my_dict[good_key_prefix+'_x_position']
+    mask = (spike_times>t_start) & (spike_times<t_stop) & (spike_positions>=x_start) & (spike_positions<=x_stop)
+    good_spike_times = spike_times[mask]
+    good_spike_positions = spike_positions[mask]
+    max_time=good_spike_times.argmax()
+    min_time=good_spike_times.argmin()
     speed=(good_spike_positions[max_time]-good_spike_positions[min_time])*10**-3/(good_spike_times[max_time]-good_spike_times[min_time])
     return speed
 
@@ -481,11 +489,10 @@ def block(my_dict,position_key=None,t_start=0,t_stop=0):
     flag    : bool or None
         True if the axon is blocked, False if not blocked and None if the test spike does not cross the stimulation near point in the simulation (no possibility to check for the axon state)
     """
-    blocked_spike_positionlist=[]
     if t_stop == 0:
         t_stop = my_dict['tstop']
     if t_start==0:
-        if 'intra_stim_starts' in my_dict and my_dict['intra_stim_starts']!=[]:
+        if 'intra_stim_starts' in my_dict and len(my_dict['intra_stim_starts'])>0:
                 t_start=my_dict['intra_stim_starts'][0]
     if position_key == None:
         if 'V_mem_filtered_raster_position' in my_dict:
@@ -495,21 +502,21 @@ def block(my_dict,position_key=None,t_start=0,t_stop=0):
         else:
             # there is no rasterized voltage, nothing to find
             return False
-    sup_time_indexes = np.where(my_dict[good_key_prefix+'_time']>t_start)
-    inf_time_indexes = np.where(my_dict[good_key_prefix+'_time']<t_stop)
-    good_indexes_time = np.intersect1d(sup_time_indexes, inf_time_indexes)
-    good_spike_times = my_dict[good_key_prefix+'_time'][good_indexes_time]
-    blocked_spike_positionlist = my_dict[good_key_prefix+'_x_position'][good_indexes_time]
-    if blocked_spike_positionlist==[]:
+    else:
+        good_key_prefix = position_key
+    spike_times = my_dict[good_key_prefix+'_time']
+    mask = (spike_times>t_start) & (spike_times<t_stop)
+    blocked_spike_positionlist = my_dict[good_key_prefix+'_x_position'][mask]
+    if blocked_spike_positionlist.size == 0:
         return None
     if 'intra_stim_positions' in my_dict:
         if my_dict['intra_stim_positions']<my_dict['extracellular_electrode_x']:
-            if max(blocked_spike_positionlist)<9./10*my_dict['L']:
+            if blocked_spike_positionlist.max()<9./10*my_dict['L']:
                 return True
             else:
                 return False
         else:
-            if min(blocked_spike_positionlist)>1./10*my_dict['L']:
+            if blocked_spike_positionlist.min()>1./10*my_dict['L']:
                 return True
             else:
                 return False
@@ -520,14 +527,16 @@ def count_spike(onset_position):
     spike counting, just in time compiled. For internal use only.
     """
     if len(onset_position)==0:
-        spike_number=0
         return 0
-    else:
-        spike_number=1
-        for i in range(len(onset_position)-1):
-            if onset_position[i]==min(onset_position):
-                if onset_position[i]==onset_position[i+1]:
-                    spike_number=spike_number+1
+    # minimum computed once, not at each iteration
+    min_position = onset_position[0]
+    for i in range(1,len(onset_position)):
+        if onset_position[i] < min_position:
+            min_position = onset_position[i]
+    spike_number=1
+    for i in range(len(onset_position)-1):
+        if onset_position[i]==min_position and onset_position[i+1]==min_position:
+            spike_number=spike_number+1
     return spike_number
 
 #############################